@@ -8,10 +8,12 @@ AWS_PLUGIN_PREFIX = "aws_integration"
 class BaseFactory:
     """Base class for all factories to ensure consistent interfaces."""
 
+    __slots__ = ("_settings",)
+
     def __init__(self, settings=None):
         self._settings = settings
 
-    def get_client(self, service_name, settings=None):
+    def get_client(self, service_name, settings=None, config=None):
         raise NotImplementedError("Subclasses must implement this method.")
 
     def get_resource(self, service_name, settings=None):
@@ -21,12 +23,16 @@ class BaseFactory:
 class AWSFactory(BaseFactory):
     """Specific factory capable of creating AWS clients and resources based on aws_model."""
 
+    __slots__ = ("_aws_model",)
+
     def __init__(self, settings, aws_model):
         super().__init__(settings)
         self._aws_model = aws_model
 
-    def get_client(self, service_name, settings=None):
-        return self._aws_model.get_aws_client(settings or self._settings, service_name)
+    def get_client(self, service_name, settings=None, config=None):
+        return self._aws_model.get_aws_client(
+            settings or self._settings, service_name, config=config
+        )
 
     def get_resource(self, service_name, settings=None):
         return self._aws_model.get_aws_resource(
@@ -37,7 +43,9 @@ class AWSFactory(BaseFactory):
 class EmptyFactory(BaseFactory):
     """Fallback factory that does nothing but log calls to show missing configurations."""
 
-    def get_client(self, service_name, settings=None):
+    __slots__ = ()
+
+    def get_client(self, service_name, settings=None, config=None):
         log.info("No operation available. Ensure plugin is configured correctly.")
         return None
 
@@ -46,21 +54,36 @@ class EmptyFactory(BaseFactory):
         return None
 
 
+_mad_hatter = None
+
+
+def _mh():
+    global _mad_hatter
+    if _mad_hatter is None:
+        _mad_hatter = MadHatter()
+    return _mad_hatter
+
+
 def factory():
     """Create an AWS client factory from the aws_integration plugin settings."""
-    mad_hatter = MadHatter()
-    for name in mad_hatter.active_plugins:
-        if name.startswith(AWS_PLUGIN_PREFIX):
-            aws_plugin = mad_hatter.plugins.get(name)
-            if aws_plugin:
-                try:
-                    plugin_settings = aws_plugin.load_settings()
-                    aws_model = aws_plugin.settings_model()
-                    if plugin_settings and aws_model:
-                        return AWSFactory(plugin_settings, aws_model)
-                except Exception as e:
-                    log.info(f"An error occurred while creating the AWS Factory: {e}")
-                break
+    mad_hatter = _mh()
+    aws_plugin = next(
+        (
+            candidate
+            for name in mad_hatter.active_plugins
+            if name.startswith(AWS_PLUGIN_PREFIX)
+            and (candidate := mad_hatter.plugins.get(name))
+        ),
+        None,
+    )
+    if aws_plugin:
+        try:
+            plugin_settings = aws_plugin.load_settings()
+            aws_model = aws_plugin.settings_model()
+            if plugin_settings and aws_model:
+                return AWSFactory(plugin_settings, aws_model)
+        except Exception as e:
+            log.info(f"An error occurred while creating the AWS Factory: {e}")
     log.info("No AWS integration plugin found or failed to initialize.")
     return EmptyFactory()
 
@@ -69,11 +92,20 @@ class Boto3:
     """Wrapper class that uses a factory to get AWS clients and resources based on plugin configuration."""
 
     def __init__(self, settings=None):
-        self.factory_instance = factory()
+        self._factory_instance = None
         self.settings = settings
 
-    def get_client(self, service_name, settings=None):
-        return self.factory_instance.get_client(service_name, settings or self.settings)
+    @property
+    def factory_instance(self):
+        # Resolved on first use so constructing Boto3 never loads plugin settings.
+        if self._factory_instance is None:
+            self._factory_instance = factory()
+        return self._factory_instance
+
+    def get_client(self, service_name, settings=None, config=None):
+        return self.factory_instance.get_client(
+            service_name, settings or self.settings, config=config
+        )
 
     def get_resource(self, service_name, settings=None):
         return self.factory_instance.get_resource(
@@ -11,15 +11,19 @@ import json
 import logging
 import re
 import time
+import weakref
 import yaml
 import click
 import boto3
 import botocore
 
+from concurrent.futures import ThreadPoolExecutor
 from tabulate import tabulate
 from typing import (
     Any,
+    Callable,
     Dict,
+    Iterator,
     List,
     Optional,
     Tuple,
@@ -30,22 +34,51 @@ from typing import (
 class AwsIamTester:
     # Defaults
     DEFAULT_SLEEP_SECONDS = 300
+    DEFAULT_MAX_WORKERS = 32
+    # the IAM list APIs accept at most 1000 items per page
+    DEFAULT_PAGE_SIZE = 1000
 
     logger: logging.Logger
     logger_initialized: bool
 
-    # define boto3 retry logic, as the simulation api might do some throttling
-    boto3_config = botocore.config.Config(retries=dict(max_attempts=10))
+    # account ids per STS client, shared by every tester using the same client
+    _account_ids = weakref.WeakKeyDictionary()
+
+    # define boto3 retry logic, as the simulation api might do some throttling,
+    # and size the connection pool for the concurrent simulations
+    boto3_config = botocore.config.Config(
+        retries=dict(max_attempts=10, mode="adaptive"),
+        max_pool_connections=64,
+    )
 
     def __init__(
-        self, debug: bool = False, sts_client=None, iam_client=None, s3_client=None
+        self,
+        debug: bool = False,
+        sts_client=None,
+        iam_client=None,
+        s3_client=None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        logger: Optional[logging.Logger] = None,
     ):
-        self.logger_initialized = False
+        # an embedding application can pass its own logger instead of the
+        # stdout one set up by get_logger
+        self.logger_initialized = logger is not None
+        if logger is not None:
+            self.logger = logger
         self.debug = debug
+        self.max_workers = max_workers
         self.sts_client = sts_client or boto3.client("sts")
         self.iam_client = iam_client or boto3.client("iam", config=self.boto3_config)
         self.s3_client = s3_client or boto3.client("s3")
 
+    def get_account_id(self) -> str:
+        "Returns the current account id, asking STS only once per client"
+        account_id = self._account_ids.get(self.sts_client)
+        if account_id is None:
+            account_id = self.sts_client.get_caller_identity()["Account"]
+            self._account_ids[self.sts_client] = account_id
+        return account_id
+
     def get_aws_data(self):
         logger = self.get_logger()
 
@@ -53,7 +86,7 @@ class AwsIamTester:
         account_alias = None
 
         # first get current account id
-        account_id = self.sts_client.get_caller_identity()["Account"]
+        account_id = self.get_account_id()
         try:
             account_alias = self.iam_client.list_account_aliases(MaxItems=1)[
                 "AccountAliases"
@@ -70,11 +103,12 @@ class AwsIamTester:
         action: str,
         resource: str,
         json_output: bool,
+        collector: Optional[Callable[[Dict], None]] = None,
     ):
         "Checks whether a given user OR role has access to a particular action and resource"
         try:
             # logger = self.get_logger()
-            account_id, account_alias = self.get_aws_data()
+            account_id = self.get_account_id()
 
             if user and role:
                 raise Exception("Pass in user or role, not both")
@@ -93,10 +127,12 @@ class AwsIamTester:
                 actions=[action],
                 resources=[resource],
                 sim_context=[],
+                quiet=collector is not None,
             )
             if json_output:
                 return self.handle_results(
                     results=results,
+                    collector=collector,
                 )
             else:
                 result = results[0]
@@ -153,7 +189,9 @@ class AwsIamTester:
 
                 return allowed
         except botocore.exceptions.ClientError as ce:
-            if re.match("^(.*)(security token|AccessDenied)(.*)$", str(ce)):
+            if not collector and re.match(
+                "^(.*)(security token|AccessDenied)(.*)$", str(ce)
+            ):
                 click.echo(
                     f"Please make sure you are logged in into AWS, with sufficient permissions."
                 )
@@ -165,10 +203,11 @@ class AwsIamTester:
         action: str,
         resource: str,
         json_output: bool,
+        collector: Optional[Callable[[Dict], None]] = None,
     ):
         try:
             logger = self.get_logger()
-            account_id, account_alias = self.get_aws_data()
+            account_id = self.get_account_id()
 
             sources = self.determine_source(
                 account_id=account_id,
@@ -182,11 +221,13 @@ class AwsIamTester:
                 actions=[action],
                 resources=[resource],
                 sim_context=[],
+                quiet=collector is not None,
             )
 
             if json_output:
                 return self.handle_results(
                     results=results,
+                    collector=collector,
                 )
             else:
                 to_print = []
@@ -214,7 +255,9 @@ class AwsIamTester:
                 self.show_summary(to_print)
 
         except botocore.exceptions.ClientError as ce:
-            if re.match("^(.*)(security token|AccessDenied)(.*)$", str(ce)):
+            if not collector and re.match(
+                "^(.*)(security token|AccessDenied)(.*)$", str(ce)
+            ):
                 click.echo(
                     f"Please make sure you are logged in into AWS, with sufficient permissions."
                 )
@@ -408,13 +451,12 @@ class AwsIamTester:
         user_landing_account: Optional[str],
         my_account: str,
         no_system_roles: bool,
-    ) -> List[str]:
-        "Read (and filter) the IAM roles in the account"
-        logger = self.get_logger()
-        roles = []
-
+    ) -> Iterator[str]:
+        "Read (and filter) the IAM roles in the account, page by page"
         paginator = self.iam_client.get_paginator("list_roles")
-        page_iterator = paginator.paginate()
+        page_iterator = paginator.paginate(
+            PaginationConfig={"PageSize": self.DEFAULT_PAGE_SIZE}
+        )
 
         for page in page_iterator:
             rolelist = page["Roles"]
@@ -435,22 +477,18 @@ class AwsIamTester:
                     # do we want to include non user assumable roles
                     not no_system_roles
                 ):
-                    roles.append(role["Arn"])
-
-        return roles
-
-    def get_iam_users(self) -> List[str]:
-        "Get all IAM users"
-        users = []
+                    yield role["Arn"]
 
+    def get_iam_users(self) -> Iterator[str]:
+        "Get all IAM users, page by page"
         paginator = self.iam_client.get_paginator("list_users")
-        page_iterator = paginator.paginate()
+        page_iterator = paginator.paginate(
+            PaginationConfig={"PageSize": self.DEFAULT_PAGE_SIZE}
+        )
         for page in page_iterator:
             userlist = page["Users"]
             for user in userlist:
-                users.append(user["Arn"])
-
-        return users
+                yield user["Arn"]
 
     def determine_source(
         self,
@@ -517,13 +555,21 @@ class AwsIamTester:
         number_of_runs: int = -1,
         dry_run: bool = False,
         counter: int = 0,
+        quiet: bool = False,
     ) -> Tuple[List[Dict], int]:
         "Evaluate the list of sources for a given configuration"
 
         logger = self.get_logger()
         logger.debug(f"Evaluate sources: {sources}")
 
+        def progress(fg: str) -> None:
+            # one dot per source on the console, unless running quietly
+            if not quiet:
+                click.secho(".", fg=fg, nl=False)
+                sys.stdout.flush()
+
         results = []
+        to_simulate = []
         for source in sources:
             if limit_to:  # do we have a limit_to?
                 exempt = True
@@ -535,8 +581,7 @@ class AwsIamTester:
                 if exempt and self.debug:
                     logger.debug(f"\nSource {source} is not included in whitelist")
                 elif exempt:
-                    click.secho(".", fg="blue", nl=False)
-                    sys.stdout.flush()
+                    progress("blue")
             else:  # or is this source exempt from testing
                 exempt = False
                 for exemption in exemptions:
@@ -547,75 +592,86 @@ class AwsIamTester:
                                 f"\nSource {source} is exempt from testing using: {exempt}"
                             )
                         else:
-                            click.secho(".", fg="blue", nl=False)
-                            sys.stdout.flush()
+                            progress("blue")
                         break
 
             counter += 1
             if 0 < number_of_runs < counter:
-                click.echo("\n")
+                if not quiet:
+                    click.echo("\n")
                 logger.debug("Test run mode activated, max iterations reached.")
                 break
             if dry_run:
                 logger.debug(f"Dry run mode, no simulation for {source}")
             elif not exempt:
-                evaluation_results = self.simulate_policy(
-                    source=source,
-                    actions=actions,
-                    resources=resources,
-                    sim_context=sim_context,
-                )
-
-                if evaluation_results:
-                    denies = [x for x in evaluation_results if self.is_denied(x)]
-                    allows = [x for x in evaluation_results if not self.is_denied(x)]
+                to_simulate.append(source)
+
+        def simulate(source: str) -> List[Dict]:
+            return self.simulate_policy(
+                source=source,
+                actions=actions,
+                resources=resources,
+                sim_context=sim_context,
+                quiet=quiet,
+            )
 
-                    if expect_failures is None:
-                        # just use all results
-                        filtered_results = evaluation_results
-                    elif expect_failures:
-                        # allows are failures
-                        filtered_results = allows
-                    else:
-                        # denies are failures
-                        filtered_results = denies
+        # every simulation is an independent API call, so run them concurrently
+        if len(to_simulate) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(len(to_simulate), self.max_workers)
+            ) as executor:
+                evaluations = list(executor.map(simulate, to_simulate))
+        else:
+            evaluations = [simulate(source) for source in to_simulate]
+
+        for source, evaluation_results in zip(to_simulate, evaluations):
+            if evaluation_results:
+                denies = [x for x in evaluation_results if self.is_denied(x)]
+                allows = [x for x in evaluation_results if not self.is_denied(x)]
+
+                if expect_failures is None:
+                    # just use all results
+                    filtered_results = evaluation_results
+                elif expect_failures:
+                    # allows are failures
+                    filtered_results = allows
+                else:
+                    # denies are failures
+                    filtered_results = denies
 
-                    success = len(filtered_results) == 0
+                success = len(filtered_results) == 0
 
-                    if expect_failures is None:
-                        results.extend(
-                            self.construct_results(
-                                source=source,
-                                results=filtered_results,
-                                print_results=self.debug,
-                            )
+                if expect_failures is None:
+                    results.extend(
+                        self.construct_results(
+                            source=source,
+                            results=filtered_results,
+                            print_results=self.debug,
                         )
-                        if not self.debug:
-                            if filtered_results[0]["EvalDecision"] == "allowed":
-                                fg = "green"
-                            else:
-                                fg = "red"
-
-                            click.secho(".", fg=fg, nl=False)
-                            sys.stdout.flush()
-                    elif success:
-                        if self.debug:
-                            click.secho(f"Success: {source}", fg="green")
+                    )
+                    if not self.debug:
+                        if filtered_results[0]["EvalDecision"] == "allowed":
+                            fg = "green"
                         else:
-                            click.secho(".", fg="green", nl=False)
-                            sys.stdout.flush()
+                            fg = "red"
+
+                        progress(fg)
+                elif success:
+                    if self.debug:
+                        click.secho(f"Success: {source}", fg="green")
                     else:
-                        results.extend(
-                            self.construct_results(
-                                source=source,
-                                results=filtered_results,
-                                print_results=self.debug,
-                            )
+                        progress("green")
+                else:
+                    results.extend(
+                        self.construct_results(
+                            source=source,
+                            results=filtered_results,
+                            print_results=self.debug,
                         )
+                    )
 
-                        if not self.debug:
-                            click.secho(".", fg="red", nl=False)
-                            sys.stdout.flush()
+                    if not self.debug:
+                        progress("red")
 
         return results, counter
 
@@ -625,6 +681,7 @@ class AwsIamTester:
         actions: List[str],
         resources: List[str],
         sim_context: List[Dict] = None,
+        quiet: bool = False,
     ) -> List[Dict]:
         """Simulate a set of actions from a specific principal against a resource"""
 
@@ -668,14 +725,17 @@ class AwsIamTester:
         try:
             return simulate(source, actions, resources, sim_context)
         except self.iam_client.exceptions.NoSuchEntityException as nsee:
-            click.echo("\n")
+            if not quiet:
+                click.echo("\n")
             logger.error(
                 f"Could not find entity {source} during simulation, has it just been removed?\n{nsee}"
             )
             # but ignore it
             return []
         except self.iam_client.exceptions.ClientError as ce:
-            if "throttling" in str(ce).lower():
+            # when quiet the caller waits on the result, so after the client's
+            # own adaptive retries fail fast instead of sleeping for minutes
+            if "throttling" in str(ce).lower() and not quiet:
                 logger.error(
                     f"Throttling of API is requested. Sleep for {self.DEFAULT_SLEEP_SECONDS} seconds and try again"
                 )
@@ -748,11 +808,13 @@ class AwsIamTester:
         write_to_file: bool = False,
         output_location: str = "",
         account: str = "",
+        collector: Optional[Callable[[Dict], None]] = None,
     ) -> int:
-        "Print the results or write them to file"
+        "Print the results, write them to file or hand them to the collector"
         logger = self.get_logger()
 
-        click.echo("\n\n")
+        if not collector:
+            click.echo("\n\n")
         logger.debug("Handle results")
         return_value = 1
         full_results = {}
@@ -825,6 +887,8 @@ class AwsIamTester:
         elif not full_results:
             logger.info("No findings found!")
             return_value = 0
+        elif collector:
+            collector(full_results)
         else:
             logger.info(f"Complete list of matching sources:\n")
             click.echo(json.dumps(full_results["sources"], indent=4))
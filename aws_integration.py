@@ -1,17 +1,67 @@
 from cat.mad_hatter.decorators import tool, hook, plugin
-from pydantic import BaseModel, Field, model_validator
+from pydantic import BaseModel, Field, field_validator, model_validator
 from typing import Optional
+from functools import lru_cache
+from cachetools import LRUCache, TTLCache
+from botocore.config import Config
 from cat.log import log
+import botocore.session
 import boto3
+import hashlib
 import json
+import threading
 from . import Boto3
 
 AWS_ACCES_KEY_LEN = 20
 AWS_SECRET_ACCES_KEY_LEN = 40
 DEFAULT_REGION = "us-east-1"
 
+# Shared by every client so cached clients keep a larger pool of keep-alive
+# connections and back off adaptively when throttled.
+BOTO3_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+
+# Merged over BOTO3_CONFIG for the plugin's own IAM/STS clients only: their
+# calls are short metadata reads, so they fail fast on a dead endpoint and
+# retry harder when throttled during the tools' fan-out.
+IAM_CLIENT_CONFIG = Config(
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    connect_timeout=3,
+    read_timeout=10,
+)
+
+# Caller identity ARNs keyed on the credential settings that produced them.
+_caller_identity_cache = TTLCache(maxsize=32, ttl=300)
+_caller_identity_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _ec2_regions() -> frozenset:
+    # A bare botocore session is enough to read the endpoint data.
+    return frozenset(botocore.session.get_session().get_available_regions("ec2"))
+
 
 class Boto3Builder:
+    # Sessions and clients are shared across builders: creating a session loads
+    # the service models from disk and creating a client resolves endpoints.
+    # Bounded, so credentials that were replaced in the settings get dropped.
+    _session_cache = LRUCache(maxsize=16)
+    _client_cache = LRUCache(maxsize=64)
+    _cache_lock = threading.RLock()
+
+    __slots__ = (
+        "service_name",
+        "profile_name",
+        "aws_access_key_id",
+        "aws_secret_access_key",
+        "endpoint_url",
+        "iam_role_assigned",
+        "region_name",
+    )
+
     def __init__(
         self,
         region_name: str,
@@ -40,36 +90,74 @@ class Boto3Builder:
     def set_endpoint_url(self, endpoint_url: str):
         self.endpoint_url = endpoint_url
 
-    def build_session(self):
+    def _session_key(self):
         if self.iam_role_assigned:
-            session = boto3.Session()
+            return (True, None, None, None)
         elif self.profile_name:
-            session = boto3.Session(profile_name=self.profile_name)
-        else:
-            session_kwargs = {}
-            if self.aws_access_key_id and self.aws_secret_access_key:
-                session_kwargs["aws_access_key_id"] = self.aws_access_key_id
-                session_kwargs["aws_secret_access_key"] = self.aws_secret_access_key
-            session = boto3.Session(**session_kwargs)
+            return (False, self.profile_name, None, None)
+        # Keyed on a digest so the secret itself is not kept as a cache key.
+        secret = (self.aws_secret_access_key or "").encode()
+        return (False, None, self.aws_access_key_id, hashlib.sha256(secret).hexdigest())
+
+    def build_session(self):
+        key = self._session_key()
+        with self._cache_lock:
+            session = self._session_cache.get(key)
+            if session is None:
+                session = self._session_cache[key] = self._new_session()
         return session
 
-    def _get_kwargs(self):
-        kwargs = {
-            "region_name": self.region_name,
-        }
-        if self.endpoint_url:
-            kwargs["endpoint_url"] = self.endpoint_url
-        return kwargs
+    def _new_session(self):
+        # Send STS calls to the configured region instead of the global
+        # us-east-1 endpoint.
+        botocore_session = botocore.session.get_session()
+        botocore_session.set_config_variable("sts_regional_endpoints", "regional")
 
-    def build_client(self, service_name):
-        session = self.build_session()
-        client_kwargs = self._get_kwargs()
-        return session.client(self.service_name or service_name, **client_kwargs)
+        if self.iam_role_assigned:
+            return boto3.Session(botocore_session=botocore_session)
+        elif self.profile_name:
+            return boto3.Session(
+                profile_name=self.profile_name, botocore_session=botocore_session
+            )
+        elif self.aws_access_key_id and self.aws_secret_access_key:
+            return boto3.Session(
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                botocore_session=botocore_session,
+            )
+        return boto3.Session(botocore_session=botocore_session)
+
+    def build_client(self, service_name, config=None):
+        # config is merged over BOTO3_CONFIG and is part of the cache key by
+        # identity, so pass a shared module-level Config rather than a new one.
+        service_name = self.service_name or service_name
+        key = (
+            self._session_key(),
+            service_name,
+            self.region_name,
+            self.endpoint_url,
+            config,
+        )
+        with self._cache_lock:
+            client = self._client_cache.get(key)
+            if client is None:
+                client = self._client_cache[key] = self.build_session().client(
+                    service_name,
+                    region_name=self.region_name,
+                    endpoint_url=self.endpoint_url or None,
+                    config=BOTO3_CONFIG.merge(config) if config else BOTO3_CONFIG,
+                )
+        return client
 
     def build_resource(self, service_name):
-        session = self.build_session()
-        resource_kwargs = self._get_kwargs()
-        return session.resource(self.service_name or service_name, **resource_kwargs)
+        # Resources are not thread-safe, so only the session is shared.
+        with self._cache_lock:
+            return self.build_session().resource(
+                self.service_name or service_name,
+                region_name=self.region_name,
+                endpoint_url=self.endpoint_url or None,
+                config=BOTO3_CONFIG,
+            )
 
 
 class AWSSettings(BaseModel):
@@ -110,48 +198,70 @@ class AWSSettings(BaseModel):
         )
 
     @classmethod
-    def get_aws_client(cls, settings, service_name) -> Optional[Boto3Builder]:
+    def get_aws_client(
+        cls, settings, service_name, config=None
+    ) -> Optional[Boto3Builder]:
         client_builder = cls.get_aws(settings)
-        return client_builder.build_client(service_name)
+        return client_builder.build_client(service_name, config=config)
 
     @classmethod
     def get_aws_resource(cls, settings, service_name) -> Optional[Boto3Builder]:
         resource_builder = cls.get_aws(settings)
         return resource_builder.build_resource(service_name)
 
+    @field_validator("aws_access_key_id")
+    @classmethod
+    def validate_access_key_id(cls, value):
+        if value and len(value) != AWS_ACCES_KEY_LEN:
+            raise ValueError("The access key or secret access key is invalid!")
+        return value
+
+    @field_validator("aws_secret_access_key")
+    @classmethod
+    def validate_secret_access_key(cls, value):
+        if value and len(value) != AWS_SECRET_ACCES_KEY_LEN:
+            raise ValueError("The access key or secret access key is invalid!")
+        return value
+
+    @field_validator("region_name")
+    @classmethod
+    def validate_region_name(cls, value):
+        if value != DEFAULT_REGION and value not in _ec2_regions():
+            raise ValueError(f"{value} is not a valid AWS region")
+        return value
+
     @model_validator(mode="after")
     def validate(cls, v):
-        session = boto3.Session()
-        available_regions = session.get_available_regions("ec2")
-        if v.region_name not in available_regions:
-            raise ValueError(f"{v.region_name} is not a valid AWS region")
-
         if not v.iam_role_assigned:
             if not v.credentials_profile_name:
                 if not v.aws_access_key_id or not v.aws_secret_access_key:
                     raise ValueError(
                         "Enable the IAM role or provide a credentials profile name or both aws_access_key_id and aws_secret_access_key."
                     )
-                elif not (
-                    len(v.aws_access_key_id) == AWS_ACCES_KEY_LEN
-                    and len(v.aws_secret_access_key) == AWS_SECRET_ACCES_KEY_LEN
-                ):
-                    raise ValueError("The access key or secret access key is invalid!")
 
-        values = cls.set_identity(v.dict())
-        v.caller_identity = values["caller_identity"]
+        key = (
+            v.aws_access_key_id,
+            v.aws_secret_access_key,
+            v.credentials_profile_name,
+            v.iam_role_assigned,
+            v.region_name,
+            v.endpoint_url,
+        )
+        with _caller_identity_lock:
+            arn = _caller_identity_cache.get(key)
+        if arn is None:
+            client = cls.get_aws_client(
+                vars(v), service_name="sts", config=IAM_CLIENT_CONFIG
+            )
+            response = client.get_caller_identity()
+            log.debug("AWS Caller Identity Response: {}".format(json.dumps(response)))
+            arn = response["Arn"]
+            with _caller_identity_lock:
+                _caller_identity_cache[key] = arn
+        v.caller_identity = arn
 
         return v
 
-    @model_validator(mode="before")
-    def set_identity(cls, values):
-        client = cls.get_aws_client(values, service_name="sts")
-        response = client.get_caller_identity()
-        log.debug("AWS Caller Identity Response: {}".format(json.dumps(response)))
-        values["caller_identity"] = response["Arn"]
-
-        return values
-
     class Config:
         extra = "forbid"
         anystr_strip_whitespace = True
@@ -0,0 +1,111 @@
+from cachetools import TTLCache
+from cachetools.keys import hashkey
+import functools
+import threading
+
+_MISSING = object()
+
+
+class _Flight:
+    """One in-progress computation, whose outcome is shared with its waiters."""
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlightCache:
+    """TTL cache where concurrent misses on the same key wait for one computation."""
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """
+        Return the cached value for key, or compute and cache it.
+
+        Callers arriving while the computation runs get its outcome, including
+        an exception or a value for which cacheable returns False. Neither of
+        those is cached, so the next call after it retries.
+        """
+        with self._lock:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            flight = self._pending.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._pending[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        store = False
+        try:
+            flight.value = compute()
+            store = cacheable is None or cacheable(flight.value)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            # The value is stored before the flight is released, so a late
+            # caller either finds it in the cache or joins this flight.
+            with self._lock:
+                if store:
+                    self._cache[key] = flight.value
+                del self._pending[key]
+            flight.done.set()
+        return flight.value
+
+    def pop(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+def memoize_unless_none(func):
+    """
+    Memoize a zero-argument factory once it returns something other than None,
+    e.g. a client that is None until the plugin has been configured.
+    """
+    lock = threading.Lock()
+    value = None
+
+    @functools.wraps(func)
+    def wrapper():
+        nonlocal value
+        if value is None:
+            with lock:
+                if value is None:
+                    value = func()
+        return value
+
+    return wrapper
+
+
+def ttl_cache(ttl, maxsize=64):
+    """Decorator caching a function's results in a SingleFlightCache."""
+    cache = SingleFlightCache(maxsize=maxsize, ttl=ttl)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return cache.get_or_compute(
+                hashkey(*args, **kwargs), lambda: func(*args, **kwargs)
+            )
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
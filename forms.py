@@ -1,6 +1,6 @@
-from typing import Dict, List, Tuple, Optional, Any
+from typing import Callable, Dict, List, Tuple, Optional, Any
 from pydantic import BaseModel, Field
-from contextlib import redirect_stdout
+from cachetools.keys import hashkey
 
 from cat.experimental.form import CatForm, CatFormState, form
 from .aws_iam_tester import AwsIamTester
@@ -8,22 +8,66 @@ from tabulate import tabulate
 from cat.log import log
 
 import functools
-from io import StringIO
 from . import Boto3
+from .caching import SingleFlightCache, memoize_unless_none
+from .aws_integration import IAM_CLIENT_CONFIG
 import json
 import requests
 import re
 
-iam_client = Boto3().get_client("iam")
-sts_client = Boto3().get_client("sts")
+_IAM_ARN_RE = re.compile(
+    r"^arn:aws:iam::\d{12}:(?P<kind>user|role|assumed-role)/[\w+=,.@-]+(/[a-zA-Z_0-9+=,.@-]+)?$"
+)
 
+# Asking to refresh or re-run a check bypasses its cached simulation result.
+_REFRESH_RE = re.compile(r"\b(refresh|re-?run|re-?check|fresh)\b", re.IGNORECASE)
 
-def jsonIndentLimit(jsonString, indent, limit):
-    regexPattern = re.compile(f"\n({indent}){{{limit}}}(({indent})+|(?=(}}|])))")
-    return regexPattern.sub("", jsonString)
+_NOT_CONFIGURED = "The AWS integration plugin is not configured yet. Please check its settings and try again."
+
+# Policy simulation results shared by all testers, keyed on method and arguments.
+_results_cache = SingleFlightCache(maxsize=1024, ttl=60)
+
+
+@memoize_unless_none
+def _iam():
+    return Boto3().get_client("iam", config=IAM_CLIENT_CONFIG)
+
+
+@memoize_unless_none
+def _sts():
+    return Boto3().get_client("sts", config=IAM_CLIENT_CONFIG)
+
+
+def _dump_limited(obj, indent: int = 2, depth_limit: int = 4, _depth: int = 0) -> str:
+    """
+    Pretty-print obj as JSON, writing containers nested at depth_limit or deeper
+    on a single line.
+    """
+    if _depth >= depth_limit or not obj or not isinstance(obj, (dict, list)):
+        return json.dumps(obj, separators=(",", ": "))
+
+    if isinstance(obj, dict):
+        items = [
+            f"{json.dumps(key)}: {_dump_limited(value, indent, depth_limit, _depth + 1)}"
+            for key, value in obj.items()
+        ]
+        opening, closing = "{", "}"
+    else:
+        items = [
+            _dump_limited(value, indent, depth_limit, _depth + 1) for value in obj
+        ]
+        opening, closing = "[", "]"
+
+    padding = "\n" + " " * indent * (_depth + 1)
+    body = ("," + padding).join(items)
+    return f"{opening}{padding}{body}\n{' ' * indent * _depth}{closing}"
 
 
 class AwsIamPolicyTester:
+    # Simulations run on the shared plugin IAM client, so keep the fan-out
+    # small enough for its retries to absorb throttling.
+    MAX_WORKERS = 8
+
     result = None
     status = None
 
@@ -36,86 +80,62 @@ class AwsIamPolicyTester:
             sts_client=sts_client,
             iam_client=iam_client,
             s3_client=s3_client,
+            max_workers=self.MAX_WORKERS,
+            logger=log,
         )
 
     def _wrapper(func):
         @functools.wraps(func)
         def inner(self, *args, **kwargs):
-            self.result = ""
-            stream = StringIO()
-            with redirect_stdout(stream):
-                self.status = func(self, *args, **kwargs)
-            self.result = stream.getvalue()
-            return self.result, self.status
+            result = {"sources": [], "results": []}
+            status = func(self, *args, collector=result.update, **kwargs)
+            self.result, self.status = result, status
+            return result, status
 
         return inner
 
-    def get_markdown(self):
-        try:
-            head_separator, sources_separator, results_separator = (
-                "INFO:",
-                " sources:",
-                " results:",
+    def _cached(func):
+        @functools.wraps(func)
+        def inner(self, *args, refresh: bool = False, **kwargs):
+            key = hashkey(func.__name__, *args, **kwargs)
+            if refresh:
+                # Only this query is simulated again, other results stay cached.
+                _results_cache.pop(key)
+            # Only one caller runs a given simulation, the others wait for it.
+            # Failures (status 2) are retried on the next call.
+            cached = _results_cache.get_or_compute(
+                key,
+                lambda: func(self, *args, **kwargs),
+                cacheable=lambda cached: cached[1] != 2,
             )
-            if all(
-                separator in self.result
-                for separator in [head_separator, sources_separator, results_separator]
-            ):
-                _, matching_sources, matching_results = self.result.split(
-                    head_separator
-                )
-
-                title_sources, array_sources = matching_sources.split(sources_separator)
-                title_sources = title_sources.strip() + sources_separator
-                array_sources = json.loads(array_sources)
-
-                title_results, array_results = matching_results.split(results_separator)
-                title_results = title_results.strip() + results_separator
-                array_results = json.loads(array_results)
-
-                json_results = jsonIndentLimit(
-                    json.dumps(array_results, indent=4), "  ", 8
-                )
-                json_sources = json.dumps(array_sources, indent=4)
-
-                return f"""
-{title_sources}
-```json
-{json_sources}
-```
+            self.result, self.status = cached
+            return cached
 
-{title_results}
-```json
-{json_results}
-```
-"""
-            else:
-                self.result = self.result.split("\n]\n[\n    {\n")
-                array_sources = json.loads((self.result[0] + "]").replace(".", ""))
-                array_results = json.loads(("[{" + self.result[1]))
+        return inner
 
-                results_count = len(array_results)
+    def get_markdown(self, result: Optional[Dict] = None):
+        result = self.result if result is None else result
+        if result.get("error"):
+            return result["error"]
+        if not result["results"]:
+            return "No findings found!"
 
-                json_results = jsonIndentLimit(
-                    json.dumps(array_results, indent=4), "  ", 8
-                )
-                json_sources = json.dumps(array_sources, indent=4)
+        json_results = _dump_limited(result["results"])
+        json_sources = json.dumps(result["sources"], indent=2)
 
-                return f"""
+        return f"""
 Complete list of matching sources:
 ```json
 {json_sources}
 ```
 
-Complete list of {results_count} results:
+Complete list of {len(result["results"])} results:
 ```json
 {json_results}
 ```
 """
-        except Exception as e:
-            log.error(f"An error occured {e}")
-            return self.result
 
+    @_cached
     @_wrapper
     def check_access(
         self,
@@ -124,9 +144,11 @@ Complete list of {results_count} results:
         user: Optional[str] = None,
         role: Optional[str] = None,
         json_output: bool = True,
+        collector: Optional[Callable[[Dict], None]] = None,
     ) -> int:
         """
         Checks whether the provided IAM identity has permissions on the provided actions and resource.
+        Without a user or role, searches which users and roles have access instead.
 
         :return: 0 upon successful completion and allowed,
                  1 upon successful completion and not allowed,
@@ -140,43 +162,45 @@ Complete list of {results_count} results:
                     action=action,
                     resource=resource,
                     json_output=json_output,
+                    collector=collector,
                 )
             else:
                 allowed = self.tester.check_access(
                     action=action,
                     resource=resource,
                     json_output=json_output,
+                    collector=collector,
                 )
             return 0 if allowed else 1
         except Exception as e:
-            print(f"Exception occurred: {e}")
+            log.error(f"Exception occurred: {e}")
+            collector({"error": f"Exception occurred: {e}"})
             if self.debug:
                 raise
             return 2
 
-    @_wrapper
-    def search_access(
-        self, action: str, resource: str = "*", json_output: bool = True
-    ) -> int:
-        """
-        Search which users and roles have access on the provided actions and resource.
 
-        :return: 0 upon successful completion and allowed,
-                 1 upon successful completion and not allowed,
-                 2 upon failures
-        """
-        try:
-            allowed = self.tester.check_access(
-                action=action,
-                resource=resource,
-                json_output=json_output,
-            )
-            return 0 if allowed else 1
-        except Exception as e:
-            print(f"Exception occurred: {e}")
-            if self.debug:
-                raise
-            return 2
+@memoize_unless_none
+def _policy_tester():
+    # Shared by all submissions: callers use the returned result rather than
+    # the instance's result/status attributes, which concurrent calls overwrite.
+    iam_client, sts_client = _iam(), _sts()
+    if iam_client is None or sts_client is None:
+        # Not configured yet: never let the tester fall back to ambient
+        # credentials, and try again on the next submission.
+        return None
+    return AwsIamPolicyTester(debug=False, iam_client=iam_client, sts_client=sts_client)
+
+
+class _PolicyCheckForm(CatForm):
+    _refresh = False
+
+    def next(self):
+        # Remember a refresh request from any turn of the form: by the time it is
+        # submitted, the latest message is usually just the confirmation.
+        message = self.cat.working_memory.user_message_json.text or ""
+        self._refresh = self._refresh or bool(_REFRESH_RE.search(message))
+        return super().next()
 
 
 class SearchAccess(BaseModel):
@@ -190,7 +214,7 @@ class SearchAccess(BaseModel):
 
 
 @form
-class SearchAccessForm(CatForm):
+class SearchAccessForm(_PolicyCheckForm):
     description = (
         "Search which users and roles have access to the provided actions and resource. "
         "The IAM policy simulator evaluates the policies attached to all identities within "
@@ -217,17 +241,16 @@ class SearchAccessForm(CatForm):
     ask_confirm = True
 
     def submit(self, form_data):
-        input_kwargs = {
-            "action": form_data.get("action"),
-            "resource": form_data.get("resource", "*"),
-        }
-
-        tester = AwsIamPolicyTester(
-            debug=False, iam_client=iam_client, sts_client=sts_client
+        tester = _policy_tester()
+        if tester is None:
+            return {"output": _NOT_CONFIGURED}
+        result, _ = tester.check_access(
+            action=form_data["action"],
+            resource=form_data.get("resource") or "*",
+            refresh=self._refresh,
         )
-        _ = tester.search_access(**input_kwargs)
 
-        return {"output": tester.get_markdown()}
+        return {"output": tester.get_markdown(result)}
 
 
 class CheckAccess(BaseModel):
@@ -244,7 +267,7 @@ class CheckAccess(BaseModel):
 
 
 @form
-class CheckAccessForm(CatForm):
+class CheckAccessForm(_PolicyCheckForm):
     description = (
         "Checks whether the provided IAM identity has permissions on the provided actions and resource. "
         "The IAM policy simulator evaluates the policies attached to a specific IAM user or role to determine "
@@ -271,10 +294,9 @@ class CheckAccessForm(CatForm):
     ask_confirm = True
 
     def _classify_identity(self, identity: str) -> str:
-        if re.match(
-            r"^arn:aws:iam::\d{12}:(role|assumed-role)/[\w+=,.@-]+(/[a-zA-Z_0-9+=,.@-]+)?$",
-            identity,
-        ):
+        # Plain user names skip the regex entirely.
+        match = identity.startswith("arn:") and _IAM_ARN_RE.match(identity)
+        if match and match.group("kind") != "user":
             return None, identity
         else:
             return identity, None
@@ -283,24 +305,23 @@ class CheckAccessForm(CatForm):
         identity = form_data.get("identity")
         user, role = self._classify_identity(identity)
 
-        input_kwargs = {
-            "user": user,
-            "role": role,
-            "action": form_data.get("action"),
-            "resource": form_data.get("resource", "*"),
-        }
-
-        tester = AwsIamPolicyTester(
-            debug=False, iam_client=iam_client, sts_client=sts_client
+        tester = _policy_tester()
+        if tester is None:
+            return {"output": _NOT_CONFIGURED}
+        result, _ = tester.check_access(
+            action=form_data["action"],
+            resource=form_data.get("resource") or "*",
+            user=user,
+            role=role,
+            refresh=self._refresh,
         )
-        _ = tester.check_access(**input_kwargs)
 
-        return {"output": tester.get_markdown()}
+        return {"output": tester.get_markdown(result)}
 
 
 if __name__ == "__main__":
     tester = AwsIamPolicyTester(debug=False)
     _ = tester.check_access(action="s3:ListBucket", user="pippo.gallo")
     print(tester.get_markdown())
-    _ = tester.search_access(action="s3:ListBucket")
+    _ = tester.check_access(action="s3:ListBucket")
     print(tester.get_markdown())
@@ -1,18 +1,230 @@
 from cat.mad_hatter.decorators import tool, hook, plugin
+from cachetools import TTLCache, cached
+from botocore.exceptions import ClientError
 from . import Boto3
+from .caching import memoize_unless_none, ttl_cache
+from .aws_integration import IAM_CLIENT_CONFIG
 from cat.log import log
+import functools
 import json
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@memoize_unless_none
+def _iam():
+    return Boto3().get_client("iam", config=IAM_CLIENT_CONFIG)
+
+
+@memoize_unless_none
+def _sts():
+    return Boto3().get_client("sts", config=IAM_CLIENT_CONFIG)
+
+
+# IAM operations for each identity type that policies can be attached to.
+_ROLE_OPERATIONS = {
+    "list_inline": "list_role_policies",
+    "list_attached": "list_attached_role_policies",
+    "get_inline": "get_role_policy",
+    "kw": "RoleName",
+}
+_DISPATCH = {
+    "user": {
+        "list_inline": "list_user_policies",
+        "list_attached": "list_attached_user_policies",
+        "get_inline": "get_user_policy",
+        "kw": "UserName",
+    },
+    "role": _ROLE_OPERATIONS,
+    "assumed-role": _ROLE_OPERATIONS,
+}
+_PRINCIPAL_TYPES = frozenset(_DISPATCH)
+_ROLE_TYPES = frozenset({"role", "assumed-role"})
+
+# The caller identity rarely changes during the life of the process.
+_identity_cache = TTLCache(maxsize=1, ttl=300)
+_identity_lock = threading.Lock()
+
+# Managed policy versions are immutable, so their documents never go stale.
+_policy_documents = {}
+
+# The default version of a managed policy can be switched at any time.
+_default_versions = TTLCache(maxsize=256, ttl=300)
+_default_versions_lock = threading.Lock()
+
+# Trust policies and the account summary, for repeated questions in a chat.
+# Trust documents change less often than the account counters.
+_trust_policies = TTLCache(maxsize=64, ttl=60)
+_trust_policies_lock = threading.Lock()
+_account_summary_cache = TTLCache(maxsize=1, ttl=30)
+_account_summary_lock = threading.Lock()
+
+# Last successful result of each cached fetch, served while IAM is throttling
+# or unavailable. Entries expire so an outage never revives an old answer.
+_last_known = TTLCache(maxsize=128, ttl=3600)
+_last_known_lock = threading.Lock()
+
+# Error codes that mean IAM could not answer, as opposed to a real answer such
+# as NoSuchEntity or AccessDenied.
+_TRANSIENT_ERROR_CODES = frozenset(
+    {
+        "Throttling",
+        "ThrottlingException",
+        "RequestLimitExceeded",
+        "ServiceUnavailable",
+        "ServiceFailure",
+        "InternalFailure",
+    }
+)
+
+# Shared pool for fanning out independent IAM calls.
+_executor = ThreadPoolExecutor(max_workers=16)
+
+
+def _pretty(obj):
+    """
+    Indented JSON for the tool answers, using orjson when it is installed.
+    Both paths use the plugin-wide 2-space layout, the only indent orjson has.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
+
+def _remember_last(fetch):
+    """Record every successful result of fetch for _or_last_known."""
+
+    @functools.wraps(fetch)
+    def wrapper(*args):
+        value = fetch(*args)
+        with _last_known_lock:
+            _last_known[(fetch.__name__, *args)] = (datetime.now(timezone.utc), value)
+        return value
+
+    return wrapper
+
+
+def _is_transient(error):
+    code = error.response.get("Error", {}).get("Code")
+    status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return code in _TRANSIENT_ERROR_CODES or status >= 500
+
+
+def _or_last_known(fetch, *args):
+    """
+    Return (result, None), or (last result, fetched at) if IAM is throttling or
+    unavailable. Any other error propagates.
+    """
+    try:
+        return fetch(*args), None
+    except ClientError as e:
+        key = (fetch.__name__, *args)
+        with _last_known_lock:
+            if not _is_transient(e):
+                # A real answer, e.g. the role is gone: never serve it again.
+                _last_known.pop(key, None)
+                raise
+            last_known = _last_known.get(key)
+        if last_known is None:
+            raise
+        log.warning(f"Serving the last known {fetch.__name__} result: {e}")
+        fetched_at, value = last_known
+        return value, fetched_at
+
 
-iam_client = Boto3().get_client("iam")
-sts_client = Boto3().get_client("sts")
+def _stale_note(fetched_at):
+    if fetched_at is None:
+        return ""
+    return f" (stale at {fetched_at:%Y-%m-%d %H:%M:%S} UTC)"
+
+
+def forget_identity_info():
+    """Drop the cached identity, e.g. after an IAM call failed with it."""
+    with _identity_lock:
+        _identity_cache.clear()
+
+
+def list_all(operation, **kwargs):
+    """Return every page of an IAM list operation merged into a single response."""
+    paginator = _iam().get_paginator(operation)
+    return paginator.paginate(
+        PaginationConfig={"PageSize": 1000}, **kwargs
+    ).build_full_result()
+
+
+@cached(cache=_identity_cache, lock=_identity_lock)
+def _caller_identity():
+    return _sts().get_caller_identity()
+
+
+@cached(cache=_default_versions, lock=_default_versions_lock)
+def _default_version_id(policy_arn):
+    return _iam().get_policy(PolicyArn=policy_arn)["Policy"]["DefaultVersionId"]
+
+
+def _policy_document(policy_arn, version_id):
+    key = (policy_arn, version_id)
+    document = _policy_documents.get(key)
+    if document is None:
+        document = _iam().get_policy_version(
+            PolicyArn=policy_arn, VersionId=version_id
+        )["PolicyVersion"]["Document"]
+        _policy_documents[key] = document
+    return document
+
+
+@cached(cache=_trust_policies, lock=_trust_policies_lock)
+@_remember_last
+def _trust_policy(role_name):
+    role = _iam().get_role(RoleName=role_name)
+    return role["Role"]["AssumeRolePolicyDocument"]
+
+
+@cached(cache=_account_summary_cache, lock=_account_summary_lock)
+@_remember_last
+def _account_summary():
+    return _iam().get_account_summary()["SummaryMap"]
+
+
+@ttl_cache(ttl=60)
+def _attached_policies(operation, **name):
+    return list_all(operation, **name)["AttachedPolicies"]
 
 
 def get_identity_info():
-    identity_info = sts_client.get_caller_identity()
+    identity_info = _caller_identity()
     arn_parts = identity_info["Arn"].split("/")
     identity_type = arn_parts[0].split(":")[-1]
     identity_name = arn_parts[-1]
-    return identity_type, identity_name, identity_info["Arn"]
+    if identity_type == "assumed-role":
+        # An assumed-role ARN ends with the session name, preceded by the role name.
+        role_name = arn_parts[-2]
+    elif identity_type == "role":
+        role_name = identity_name
+    else:
+        role_name = None
+    return identity_type, identity_name, identity_info["Arn"], role_name
+
+
+def _as_list(value):
+    """Policy elements hold either a single value or a list of them."""
+    return [value] if isinstance(value, (str, dict)) else (value or [])
+
+
+def _principal(identity_type, identity_name, role_name):
+    """Return the IAM operations for the identity type and its name argument."""
+    operations = _DISPATCH[identity_type]
+    principal_name = identity_name if identity_type == "user" else role_name
+    return operations, {operations["kw"]: principal_name}
 
 
 @tool(
@@ -39,8 +251,8 @@ def get_aws_identity_info(tool_input, cat):
     AWS IAM user or role and does not take an identity as input.
     """
     try:
-        identity_type, identity_name, identity_arn = get_identity_info()
-        if identity_type in ("user"):
+        identity_type, identity_name, identity_arn, role_name = get_identity_info()
+        if identity_type == "user":
             return f"The username is {identity_name}."
         else:
             return f"I don't have a username, I am using an IAM role: {identity_arn}."
@@ -73,29 +285,17 @@ def get_policies(tool_input, cat):
     identity that is making the request.
     """
     try:
-        identity_type, identity_name, identity_arn = get_identity_info()
-        if identity_type in ("user", "role", "assumed-role"):
-            if identity_type == "user":
-                attached_policies = iam_client.list_attached_user_policies(
-                    UserName=identity_name
-                )
-            elif identity_type == "assumed-role":
-                role_name = identity_arn.split("/")[-2]
-                attached_policies = iam_client.list_attached_role_policies(
-                    RoleName=role_name
-                )
-            else:
-                attached_policies = iam_client.list_attached_role_policies(
-                    RoleName=identity_name
-                )
-            policies = [
-                policy["PolicyName"] for policy in attached_policies["AttachedPolicies"]
-            ]
+        identity_type, identity_name, identity_arn, role_name = get_identity_info()
+        if identity_type in _PRINCIPAL_TYPES:
+            operations, name = _principal(identity_type, identity_name, role_name)
+            attached_policies = _attached_policies(operations["list_attached"], **name)
+            policies = [policy["PolicyName"] for policy in attached_policies]
             return f"The attached policies are: {', '.join(policies)}."
         else:
             return f"Permissions are not applicable for identity type: {identity_type}"
     except Exception as e:
         log.error(f"Error fetching permissions: {e}")
+        forget_identity_info()
         return "An error occurred while fetching the permissions. Please check the AWS IAM client configuration."
 
 
@@ -120,7 +320,7 @@ def get_account_id(tool_input, cat):
     and does not take an identity as input.
     """
     try:
-        response = sts_client.get_caller_identity()
+        response = _caller_identity()
         return f"The AWS account ID is: {response['Account']}."
     except Exception as e:
         log.error(f"Error fetching account ID: {e}")
@@ -149,11 +349,11 @@ def get_identity_information(tool_input, cat):
     and does not take an identity as input.
     """
     try:
-        caller_identity = sts_client.get_caller_identity()
+        caller_identity = _caller_identity()
         return f"""
 Here are the Caller Identity Info:
 ```json
-{json.dumps(caller_identity, indent=4)}
+{_pretty(caller_identity)}
 ```
 """
     except Exception as e:
@@ -182,7 +382,7 @@ def get_identity_type(tool_input, cat):
     Note: This tool only works for detecting the identity type of the current authenticated AWS IAM user and does not take an identity as input.
     """
     try:
-        identity_type, identity_name, identity_arn = get_identity_info()
+        identity_type, identity_name, identity_arn, role_name = get_identity_info()
         return f"The current identity is {identity_type}."
     except Exception as e:
         log.error(f"Error determining identity type: {e}")
@@ -211,72 +411,56 @@ def get_groups(tool_input, cat):
     AWS IAM user and does not take an identity as input.
     """
     try:
-        identity_type, identity_name, identity_arn = get_identity_info()
+        identity_type, identity_name, identity_arn, role_name = get_identity_info()
         if identity_type == "user":
-            user_groups = iam_client.list_groups_for_user(UserName=identity_name)
+            user_groups = list_all("list_groups_for_user", UserName=identity_name)
             groups = [group["GroupName"] for group in user_groups["Groups"]]
             return f"The current IAM user belongs to the following groups: {','.join(groups)}."
         else:
             return "Roles do not belong to IAM groups."
     except Exception as e:
         log.error(f"Error fetching groups: {e}")
+        forget_identity_info()
         return "An error occurred while fetching the IAM groups. Please check the AWS IAM client configuration."
 
 
 def get_permissions(tool_input, cat):
     try:
-        identity_type, identity_name, identity_arn = get_identity_info()
-        if identity_type in ["user", "role", "assumed-role"]:
-            if identity_type == "user":
-                inline_policies = iam_client.list_user_policies(UserName=identity_name)
-            else:
-                role_name = (
-                    identity_name
-                    if identity_type == "role"
-                    else identity_arn.split("/")[-2]
-                )
-                inline_policies = iam_client.list_role_policies(RoleName=role_name)
+        identity_type, identity_name, identity_arn, role_name = get_identity_info()
+        if identity_type in _PRINCIPAL_TYPES:
+            # The IAM calls are independent round-trips, so they are issued
+            # concurrently: both listings first, then every policy document.
+            operations, name = _principal(identity_type, identity_name, role_name)
+            inline_future = _executor.submit(
+                list_all, operations["list_inline"], **name
+            )
+            attached_future = _executor.submit(
+                _attached_policies, operations["list_attached"], **name
+            )
+            get_policy = getattr(_iam(), operations["get_inline"])
+
+            def get_inline_policy(policy_name):
+                return get_policy(PolicyName=policy_name, **name)
+
+            def get_managed_policy(policy_arn):
+                return _policy_document(policy_arn, _default_version_id(policy_arn))
+
+            policy_names = inline_future.result()["PolicyNames"]
+            inline_policies = _executor.map(get_inline_policy, policy_names)
+            attached_policies = attached_future.result()
+            managed_documents = _executor.map(
+                get_managed_policy, [policy["PolicyArn"] for policy in attached_policies]
+            )
+
             policies = {}
-            for policy_name in inline_policies["PolicyNames"]:
-                if identity_type == "user":
-                    policy = iam_client.get_user_policy(
-                        UserName=identity_name, PolicyName=policy_name
-                    )
-                else:
-                    role_name = (
-                        identity_name
-                        if identity_type == "role"
-                        else identity_arn.split("/")[-2]
-                    )
-                    policy = iam_client.get_role_policy(
-                        RoleName=role_name, PolicyName=policy_name
-                    )
+            for policy_name, policy in zip(policy_names, inline_policies):
                 policies[policy_name] = policy["PolicyDocument"]
-            if identity_type == "user":
-                attached_policies = iam_client.list_attached_user_policies(
-                    UserName=identity_name
-                )
-            else:
-                role_name = (
-                    identity_name
-                    if identity_type == "role"
-                    else identity_arn.split("/")[-2]
-                )
-                attached_policies = iam_client.list_attached_role_policies(
-                    RoleName=role_name
-                )
-            for policy in attached_policies["AttachedPolicies"]:
-                policy_arn = policy["PolicyArn"]
-                policy_version = iam_client.get_policy(PolicyArn=policy_arn)["Policy"][
-                    "DefaultVersionId"
-                ]
-                policy_document = iam_client.get_policy_version(
-                    PolicyArn=policy_arn, VersionId=policy_version
-                )["PolicyVersion"]["Document"]
+            for policy, policy_document in zip(attached_policies, managed_documents):
                 policies[policy["PolicyName"]] = policy_document
             return policies
     except Exception as e:
         log.error(f"Error fetching policies: {e}")
+        forget_identity_info()
     return {}
 
 
@@ -303,60 +487,37 @@ def get_effective_permissions(tool_input, cat):
     """
     try:
         policies = get_permissions(None, None)
-        effective_permissions = {}
-
-        def add_permission(permission_type, permission, resource, effect):
-            if permission not in effective_permissions:
-                effective_permissions[permission] = {"Allow": [], "Deny": []}
-            if effect == "Allow":
-                effective_permissions[permission]["Allow"].append(resource)
-            elif effect == "Deny":
-                effective_permissions[permission]["Deny"].append(resource)
+        effective_permissions = defaultdict(lambda: {"Allow": set(), "Deny": set()})
 
         for policy_name, policy_document in policies.items():
-            for statement in policy_document["Statement"]:
+            for statement in _as_list(policy_document.get("Statement")):
                 effect = statement.get("Effect")
+                if not effect:
+                    continue
 
-                actions = statement.get("Action", [])
-                if isinstance(actions, str):
-                    actions = [actions]
-
-                not_actions = statement.get("NotAction", [])
-                if isinstance(not_actions, str):
-                    not_actions = [not_actions]
-
-                resources = statement.get("Resource", [])
-                if isinstance(resources, str):
-                    resources = [resources]
-
-                not_resources = statement.get("NotResource", [])
-                if isinstance(not_resources, str):
-                    not_resources = [not_resources]
-
-                for action in actions:
-                    for resource in resources:
-                        add_permission("Action", action, resource, effect)
-
-                for not_action in not_actions:
-                    for resource in resources:
-                        add_permission("NotAction", not_action, resource, effect)
-
-                for action in actions:
-                    for not_resource in not_resources:
-                        add_permission("Action", action, not_resource, effect)
+                permissions = _as_list(statement.get("Action")) + _as_list(
+                    statement.get("NotAction")
+                )
+                resources = _as_list(statement.get("Resource")) + _as_list(
+                    statement.get("NotResource")
+                )
+                if not (permissions and resources):
+                    continue
 
-                for not_action in not_actions:
-                    for not_resource in not_resources:
-                        add_permission("NotAction", not_action, not_resource, effect)
+                for permission, resource in product(permissions, resources):
+                    effects = effective_permissions[permission]
+                    if effect in effects:
+                        effects[effect].add(resource)
 
-        for permission, effects in effective_permissions.items():
-            effects["Allow"] = sorted(list(set(effects["Allow"])))
-            effects["Deny"] = sorted(list(set(effects["Deny"])))
+        effective_permissions = {
+            permission: {effect: sorted(resources) for effect, resources in effects.items()}
+            for permission, effects in effective_permissions.items()
+        }
 
         return f"""
 The effective permissions for the current IAM identity are: 
 ```json
-{json.dumps(effective_permissions, indent=4)}
+{_pretty(effective_permissions)}
 ```
 """
     except Exception as e:
@@ -386,9 +547,9 @@ def get_mfa_status(tool_input, cat):
     and does not take an identity as input.
     """
     try:
-        identity_type, identity_name, identity_arn = get_identity_info()
+        identity_type, identity_name, identity_arn, role_name = get_identity_info()
         if identity_type == "user":
-            mfa_devices = iam_client.list_mfa_devices(UserName=identity_name)
+            mfa_devices = _iam().list_mfa_devices(UserName=identity_name)
             if mfa_devices["MFADevices"]:
                 return "MFA is enabled."
             else:
@@ -397,6 +558,7 @@ def get_mfa_status(tool_input, cat):
             return "MFA is applicable only for IAM users."
     except Exception as e:
         log.error(f"Error fetching MFA status: {e}")
+        forget_identity_info()
         return "An error occurred while fetching the MFA status. Please check the AWS IAM client configuration."
 
 
@@ -422,25 +584,20 @@ def get_trust_policy(tool_input, cat):
     AWS IAM role and does not take an identity as input.
     """
     try:
-        identity_type, identity_name, identity_arn = get_identity_info()
-        if identity_type in ["role", "assumed-role"]:
-            role_name = (
-                identity_name
-                if identity_type == "role"
-                else identity_arn.split("/")[-2]
-            )
-            role = iam_client.get_role(RoleName=role_name)
-            trust_policy = role["Role"]["AssumeRolePolicyDocument"]
+        identity_type, identity_name, identity_arn, role_name = get_identity_info()
+        if identity_type in _ROLE_TYPES:
+            trust_policy, fetched_at = _or_last_known(_trust_policy, role_name)
             return f"""
-The trust policies for the current IAM identity are: 
+The trust policies for the current IAM identity are{_stale_note(fetched_at)}: 
 ```json
-{json.dumps(trust_policy, indent=4)}
+{_pretty(trust_policy)}
 ```
 """
         else:
             return f"Trust policy is not applicable for identity type:  {identity_type}"
     except Exception as e:
         log.error(f"Error fetching trust policy: {e}")
+        forget_identity_info()
         return "An error occurred while fetching the trust policy. Please check the AWS IAM client configuration."
 
 
@@ -466,13 +623,30 @@ def get_account_summary(tool_input, cat):
     authenticated AWS account and does not take an identity as input.
     """
     try:
-        account_summary = iam_client.get_account_summary()
+        account_summary, fetched_at = _or_last_known(_account_summary)
         return f"""
-The account summary is:
+The account summary is{_stale_note(fetched_at)}:
 ```json
-{json.dumps(account_summary['SummaryMap'], indent=4)}
+{_pretty(account_summary)}
 ```
 """
     except Exception as e:
         log.error(f"Error fetching account summary: {e}")
         return "An error occurred while fetching the account summary. Please check the AWS IAM client configuration."
+
+
+def _prefetch():
+    # get_permissions swallows and logs its own errors.
+    get_permissions(None, None)
+
+
+@hook
+def after_cat_bootstrap(cat):
+    """Optionally warm the identity and policy caches in the background.
+
+    Set AWS_IAM_PLUGIN_PREFETCH=1 to resolve the caller identity and fetch the
+    attached policy documents while the user is still typing, so the first IAM
+    tool call is served from the caches.
+    """
+    if os.environ.get("AWS_IAM_PLUGIN_PREFETCH") == "1":
+        threading.Thread(target=_prefetch, daemon=True).start()